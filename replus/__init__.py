@@ -17,15 +17,33 @@ __author__ = 'Biagio Distefano'
 
 
 import abc
+import hashlib
+import heapq
 import json
 import os
+import pickle
+import sys
+import tempfile
+import threading
 from pathlib import Path
-from typing import Any, List, Tuple, Union, Dict, Optional, Generator
+from typing import Any, List, Tuple, Union, Dict, Optional, Generator, Iterator, Sequence
 from collections import Counter
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import cached_property, lru_cache
+from operator import attrgetter, itemgetter
 
 import regex
 
+try:
+    from orjson import loads as json_loads
+except ImportError:  # pragma: no cover
+    from json import loads as json_loads  # type: ignore[assignment]
+
+try:
+    import ahocorasick
+except ImportError:  # pragma: no cover
+    ahocorasick = None
+
 from .exceptions import NoSuchGroup, UnknownTemplateGroup, RepeatedSpecialGroup, PatternBuildException
 
 
@@ -34,22 +52,26 @@ class Replus:
     """
     The Replus engine class builds and compiles regular expressions based on templates.
 
-    :ivar group_counter: a Counter object to count group name occurrence on each template
     :ivar patterns: a list of tuples made of [(key, pattern, template), ...]
     :ivar patterns_src: a dict containing all of patterns_dir/\\*.json combined together, "patterns" excluded
     :ivar patterns_all: all patterns that can be run, e.g. {"dates": [pattern0, pattern1], ...}
-    :ivar all_groups: a dict of list with the templates as keys, e.g. {pattern_template_a: [group_0, group_1],
-                    pattern_template_b: [group_0, group_1]}
+    :ivar all_groups: a dict of tuples with the templates as keys, e.g. {pattern_template_a: (group_0, group_1),
+                    pattern_template_b: (group_0, group_1)}
+    :ivar group_index: a dict mapping each template to a {group_name: position} dict of its groups
     :ivar flags: the regex flags to compile the patterns
     :ivar whitespace_noise: a pattern to replace white space in the template
+    :ivar max_workers: the number of processes used to compile the patterns
+    :ivar cache_dir: the directory where the built patterns are cached
     """
 
     group_pattern = r"{{((?P<special>#|\?[:>!=]|\?[aimsxl]:|\?<[!=])?(?P<key>[\w_]+)(@(?P<index>\d+))?)}}"  # regex used to match the groups' placeholder  # noqa E501
+    _special_keys = ("?:", "?>", "?!", "?=", "?<=", "?<!", "?a:", "?i:", "?m:", "?s:", "?x:", "?l:")  # by priority
 
     def __init__(
             self,
             patterns_dir_or_dict: Union[str, os.PathLike, Dict[str, Dict]],
-            whitespace_noise: Optional[str] = None, flags: Optional[int] = regex.V0
+            whitespace_noise: Optional[str] = None, flags: Optional[int] = regex.V1,
+            max_workers: Optional[int] = None, cache_dir: Optional[Union[str, os.PathLike]] = None
     ):
         """
         Instantiates the Replus engine
@@ -61,19 +83,97 @@ class Replus:
         :param whitespace_noise: a pattern to replace white space in the template
         :type whitespace_noise: str, defaults to None
 
-        :param flags: the regex flags to compile the patterns
-        :type flags: int, defaults to regex.V0
+        :param flags: the regex flags to compile the patterns; the regex module's version 1 behaviour (nested sets and
+                      set operations, full case-folding) is added to them unless they include regex.V0
+        :type flags: int, defaults to regex.V1
+
+        :param max_workers: if greater than 1, the patterns are compiled by a pool of that many processes
+        :type max_workers: int, defaults to None
+
+        :param cache_dir: if given, the built and compiled patterns are pickled in this directory and loaded from there
+                          by any engine instantiated with the same templates, whitespace noise and flags; the cache is
+                          loaded with pickle, so the directory must only be writable by trusted users
+        :type cache_dir: Union[str, os.PathLike], defaults to None
         """
 
-        self.group_counter: Counter = Counter()
         self.patterns: List[Tuple[str, regex.Pattern, str]] = []
-        self.patterns_src: Dict[str, List[str]] = {}
+        self.patterns_src: Dict[str, Tuple[str, ...]] = {}
         self.patterns_all: Dict[str, List[str]] = {}
-        self.all_groups: Dict[str, List[str]] = defaultdict(list)
+        self.all_groups: Dict[str, Tuple[str, ...]] = {}
+        self.group_index: Dict[str, Dict[str, int]] = {}
         self.patterns_src, self.patterns_all = self._load_models(patterns_dir_or_dict)
-        self.flags = flags
+        self._special_alts: Dict[str, Tuple[str, Tuple[str, ...]]] = {}
+        for sk in self._special_keys:
+            for k, alts in self.patterns_src.items():
+                if k.startswith(sk):
+                    self._special_alts.setdefault(k[len(sk):], (sk, alts))
+        self._src_digest = hashlib.blake2b(json.dumps(sorted(self.patterns_src.items())).encode()).hexdigest()
+        self.flags = _version_flags(flags)
         self.whitespace_noise = whitespace_noise
-        self._build_patterns()
+        self._noise_replacement = f"({whitespace_noise})" if whitespace_noise is not None else None
+        self.max_workers = max_workers
+        self.cache_dir = cache_dir
+        self._required_literals: Dict[str, str] = {}
+        cache_path = self._cache_path()
+        if cache_path is None or not self._load_cache(cache_path):
+            self._build_patterns()
+            if cache_path is not None:
+                self._dump_cache(cache_path)
+        self._by_key: Dict[str, List[int]] = {}
+        for i, (key, _, _) in enumerate(self.patterns):
+            self._by_key.setdefault(key, []).append(i)
+        self._literals_automaton = self._build_literals_automaton()
+        self._group_ids: Dict[str, Tuple[int, ...]] = {
+            template: tuple(pattern.groupindex[name] for name in self.all_groups[template])
+            for _, pattern, template in self.patterns
+        }
+
+    @classmethod
+    def cached(
+            cls,
+            patterns_dir: Union[str, os.PathLike],
+            whitespace_noise: Optional[str] = None, flags: Optional[int] = regex.V1,
+            max_workers: Optional[int] = None, cache_dir: Optional[Union[str, os.PathLike]] = None
+    ) -> "Replus":
+        """
+        Returns a shared engine for the given configuration, building it only the first time it is requested.
+        The engine can be used by several threads at once; later changes to the pattern files are not picked up.
+
+        :param patterns_dir: the path to the directory where the \\*.json pattern templates are stored
+        :type patterns_dir: Union[str, os.PathLike]
+
+        :param whitespace_noise: a pattern to replace white space in the template
+        :type whitespace_noise: str, defaults to None
+
+        :param flags: the regex flags to compile the patterns
+        :type flags: int, defaults to regex.V1
+
+        :param max_workers: if greater than 1, the patterns are compiled by a pool of that many processes
+        :type max_workers: int, defaults to None
+
+        :param cache_dir: the directory where the built patterns are cached
+        :type cache_dir: Union[str, os.PathLike], defaults to None
+
+        :return: a Replus engine
+        :rtype: Replus
+        """
+
+        return _cached_engine(
+            cls, os.path.abspath(os.fspath(patterns_dir)), whitespace_noise=whitespace_noise,  # type: ignore[arg-type]
+            flags=_version_flags(flags), max_workers=max_workers,
+            cache_dir=None if cache_dir is None else os.path.abspath(os.fspath(cache_dir))
+        )
+
+    @cached_property
+    def patterns_by_key(self) -> Dict[str, List[regex.Pattern]]:
+        """
+        The compiled patterns grouped by pattern type, e.g. {"dates": [pattern0, pattern1], ...}, built on first access
+
+        :return: the compiled patterns of each pattern type
+        :rtype: Dict[str, List[regex.Pattern]]
+        """
+
+        return {key: [self.patterns[i][1] for i in indices] for key, indices in self._by_key.items()}
 
     def parse(
         self,
@@ -88,6 +188,7 @@ class Replus:
         concurrent: Optional[bool] = None,
         timeout: Optional[float] = None,
         ignore_unused: Optional[bool] = False,
+        parallel: bool = False,
         **kwargs: Any
     ) -> Union[List["Match"], List["Group"]]:
         """
@@ -126,36 +227,32 @@ class Replus:
         :param ignore_unused: ignore unused
         :type ignore_unused: bool, defaults to False
 
+        :param parallel: if True, the patterns are scanned with concurrent=True by a pool of threads, one per CPU and
+                         shared by all engines, so that the regex module releases the GIL while matching; it pays off
+                         on large strings and multiple cores
+        :type parallel: bool, defaults to False
+
         :return: a list of Match objects
         :rtype: List[Match]
         """
 
-        if filters is None:
-            filters = []
-        if exclude is None:
-            exclude = []
-        matches = []
-        for k, pattern, template in self.patterns:
-            if filters and k not in filters or (k in exclude):
-                continue
-            for m in regex.finditer(
-                pattern=pattern,
-                string=string,
-                flags=flags,
-                pos=pos,
-                endpos=endpos,
-                overlapped=overlapped,
-                partial=partial,
-                concurrent=concurrent,
-                timeout=timeout,
-                ignore_unused=ignore_unused,
-                **kwargs
-            ):
-                match = Match(k, m, self.all_groups[template], pattern)
-                matches.append(match)
+        matches = list(self._iter_matches(
+            string=string,
+            filters=filters,
+            exclude=exclude,
+            pos=pos,
+            endpos=endpos,
+            flags=flags,
+            overlapped=overlapped,
+            partial=partial,
+            concurrent=concurrent,
+            timeout=timeout,
+            ignore_unused=ignore_unused,
+            parallel=parallel,
+            **kwargs
+        ))
         if not overlapped:
-            return self.purge_overlaps(matches)
-        matches.sort(key=lambda x: x._start)
+            return self._purge_sorted(matches)  # merged in order of start, reversed patterns included
         return matches
 
     def search(
@@ -213,93 +310,269 @@ class Replus:
         :rtype: Match
         """
 
-        for m in self.parse(
+        matches = self._iter_matches(
             string=string,
             filters=filters,
             exclude=exclude,
-            flags=flags,
             pos=pos,
             endpos=endpos,
+            flags=flags,
             overlapped=overlapped,
             partial=partial,
             concurrent=concurrent,
             timeout=timeout,
             ignore_unused=ignore_unused,
             **kwargs
-        ):
-            return m
-        return None
+        )
+        first = next(matches, None)
+        if first is None or overlapped:
+            return first
+        # same sweep as purge_overlaps, stopped as soon as the first kept match can no longer be replaced
+        for m in matches:
+            if m._start >= first._end:
+                break
+            if m._end >= first._end and m.length > first.length:
+                first = m
+        return first
+
+    def _iter_matches(
+        self,
+        string: str,
+        filters: Optional[List[str]] = None,
+        exclude: Optional[List[str]] = None,
+        pos: Optional[int] = None,
+        endpos: Optional[int] = None,
+        flags: Optional[int] = 0,
+        overlapped: Optional[bool] = False,
+        partial: Optional[bool] = False,
+        concurrent: Optional[bool] = None,
+        timeout: Optional[float] = None,
+        parallel: bool = False,
+        **kwargs: Any
+    ) -> Iterator["Match"]:
+        # lazily yields the matches of all the selected patterns, merged by start offset; ties keep pattern order;
+        # the remaining kwargs (e.g. ignore_unused) have no effect on already compiled patterns
+        excluded = frozenset(exclude) if exclude else frozenset()
+        if filters:
+            indices = sorted(i for k in frozenset(filters) - excluded for i in self._by_key.get(k, ()))
+            patterns = [self.patterns[i] for i in indices]  # in engine order, which breaks ties between matches
+        else:
+            patterns = [p for p in self.patterns if p[0] not in excluded] if excluded else self.patterns
+        scan_args = (pos, endpos, overlapped, concurrent, partial, timeout)
+        start = pos or 0
+        # templates whose required literal is missing from the string cannot match and are not scanned at all
+        prefilter = not flags and not partial and start >= 0 and (endpos is None or endpos >= 0)
+        found = None
+        if prefilter and self._literals_automaton is not None and len(patterns) >= _AUTOMATON_MIN_TEMPLATES:
+            end = len(string) if endpos is None else min(endpos, len(string))
+            found = {literal for _, literal in self._literals_automaton.iter(string, start, end)}
+        selected = []
+        for k, pattern, template in patterns:
+            literal = self._required_literals[template]
+            if prefilter and literal:
+                if found is not None:
+                    if literal not in found:
+                        continue
+                elif string.find(literal, start, endpos) < 0:
+                    continue
+            selected.append((k, pattern, template))
+        if parallel and not flags and len(selected) > 1:
+            # the patterns are consumed by worker threads, while the Match objects are built lazily when merging
+            executor = _scan_executor()
+            concurrent_args = (pos, endpos, overlapped, True, partial, timeout)
+            scans = [
+                executor.submit(list, pattern.finditer(string, *concurrent_args)) for _, pattern, _ in selected
+            ]
+            iterators = [
+                self._iter_pattern(k, pattern, template, string, flags, scan_args, scan.result())
+                for (k, pattern, template), scan in zip(selected, scans)
+            ]
+        else:
+            iterators = [
+                self._iter_pattern(k, pattern, template, string, flags, scan_args) for k, pattern, template in selected
+            ]
+        return heapq.merge(*iterators, key=attrgetter("_start"))
+
+    def _build_literals_automaton(self) -> Any:
+        # with many distinct required literals, a single Aho-Corasick pass beats one str.find per template
+        literals = set(filter(None, self._required_literals.values()))
+        if ahocorasick is None or len(literals) < _AUTOMATON_MIN_LITERALS:
+            return None
+        automaton = ahocorasick.Automaton()
+        for literal in literals:
+            automaton.add_word(literal, literal)
+        automaton.make_automaton()
+        return automaton
+
+    def _iter_pattern(
+        self, key: str, pattern: regex.Pattern, template: str, string: str, flags: Optional[int], scan_args: tuple,
+        scanned: Optional[List[regex.regex.Match]] = None
+    ) -> Iterator["Match"]:
+        # the compiled pattern is scanned directly, skipping the module-level regex.finditer which would look it up
+        # in the compilation cache on every call
+        if flags:
+            raise ValueError("cannot process flags argument with a compiled pattern")
+        all_group_names = self.all_groups[template]
+        group_index = self.group_index[template]
+        group_ids = self._group_ids[template]
+        matches = pattern.finditer(string, *scan_args) if scanned is None else scanned
+        if pattern.flags & regex.REVERSE:
+            # reversed patterns are scanned from the end of the string, while the merge expects ascending starts
+            matches = sorted(matches, key=regex.Match.start)
+        for m in matches:
+            yield Match(key, m, all_group_names, pattern, group_index, group_ids)
 
     def _build_patterns(self) -> None:
+        built = []
         for key, patterns in self.patterns_all.items():
             for pattern in patterns:
-                self.group_counter = Counter()
                 try:
-                    self.patterns.append(
-                        (
-                            key,
-                            regex.compile(self._build_pattern(pattern, pattern), flags=self.flags),
-                            pattern
-                        )
-                    )
+                    built_pattern, group_names = self._expand_template(pattern)
                 except Exception as e:
                     raise PatternBuildException(f"Fatal error building patterns in file '{key}.json'", *e.args)
-
-    def _build_pattern(self, pattern: str, template: str) -> str:
-        for group_match in regex.finditer(self.group_pattern, pattern):
-            return self._build_pattern(self._build_group(group_match, pattern, template), template)
-        if self.whitespace_noise is not None:
-            pattern = regex.sub(r" +|\\\s+", f"({self.whitespace_noise})", pattern)
+                built.append((key, built_pattern, pattern))
+                self.all_groups[pattern] = group_names
+                self.group_index[pattern] = {name: i for i, name in enumerate(group_names)}
+        for (key, _, template), compiled in zip(built, self._compile_patterns([p for _, p, _ in built])):
+            if isinstance(compiled, Exception):
+                raise PatternBuildException(f"Fatal error building patterns in file '{key}.json'", *compiled.args)
+            self.patterns.append((key, compiled, template))
+            self._required_literals[template] = _required_literal(compiled)
+
+    def _cache_path(self) -> Optional[Path]:
+        if self.cache_dir is None:
+            return None
+        key = json.dumps([
+            self._src_digest, list(self.patterns_all.items()), self.whitespace_noise, self.flags,
+            regex.__version__, __version__, _CACHE_FORMAT
+        ])
+        return Path(self.cache_dir) / f"{hashlib.blake2b(key.encode()).hexdigest()}.pkl"
+
+    def _load_cache(self, cache_path: Path) -> bool:
+        # whatever cannot be read or does not fit these templates is ignored and the patterns are built again
+        try:
+            with open(cache_path, "rb") as f:
+                patterns, all_groups, group_index, required_literals = pickle.load(f)
+            expected = [(key, template) for key, templates in self.patterns_all.items() for template in templates]
+            valid = (
+                isinstance(patterns, list) and isinstance(all_groups, dict) and isinstance(group_index, dict)
+                and isinstance(required_literals, dict)
+                and [(key, template) for key, _, template in patterns] == expected
+                and all(
+                    isinstance(pattern, regex.Pattern) and isinstance(required_literals.get(template), str)
+                    and isinstance(all_groups.get(template), tuple)
+                    and all(name in pattern.groupindex for name in all_groups[template])
+                    and group_index.get(template) == {name: i for i, name in enumerate(all_groups[template])}
+                    for _, pattern, template in patterns
+                )
+            )
+        except Exception:
+            return False
+        if not valid:
+            return False
+        self.patterns = patterns
+        self.all_groups = all_groups
+        self.group_index = group_index
+        self._required_literals = required_literals
+        return True
+
+    def _dump_cache(self, cache_path: Path) -> None:
+        # written to a temporary file and then renamed, so concurrent engines never read a partial cache;
+        # the cache is only an optimisation, so a directory that cannot be written to is ignored
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(
+                    (self.patterns, self.all_groups, self.group_index, self._required_literals), f,
+                    protocol=pickle.HIGHEST_PROTOCOL
+                )
+            os.replace(tmp_path, cache_path)
+        except BaseException as e:
+            os.unlink(tmp_path)
+            if not isinstance(e, OSError):
+                raise
+
+    def _compile_patterns(self, patterns: List[str]) -> List[Union[regex.Pattern, Exception]]:
+        jobs = [(pattern, self.flags) for pattern in patterns]
+        if self.max_workers is None or self.max_workers <= 1 or len(jobs) <= 1:
+            return list(map(_compile_pattern, jobs))
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(_compile_pattern, jobs))
+
+    def _expand_template(self, template: str) -> Tuple[str, Tuple[str, ...]]:
+        # the expansion only depends on the templates' sources and the whitespace noise, so it is shared by engines
+        cache_key = (self._src_digest, self.whitespace_noise, template)
+        if (expansion := _EXPANSIONS.get(cache_key)) is None:
+            group_names: List[str] = []
+            expansion = self._build_pattern(template, template, Counter(), group_names), tuple(group_names)
+            with _EXPANSIONS_LOCK:  # engines may be built from several threads
+                if len(_EXPANSIONS) >= _EXPANSIONS_MAXSIZE:
+                    del _EXPANSIONS[next(iter(_EXPANSIONS))]
+                _EXPANSIONS[cache_key] = expansion
+        return expansion
+
+    def _build_pattern(self, pattern: str, template: str, group_counter: Counter, group_names: List[str]) -> str:
+        pattern = self._expand(pattern, template, group_counter, group_names)
+        if self._noise_replacement is not None:
+            pattern = _WS_NOISE_RE.sub(self._noise_replacement, pattern)
         return pattern
 
-    def _build_group(self, group_match: regex.regex.Match, pattern: str, template: str) -> str:
+    def _expand(
+            self, pattern: str, template: str, group_counter: Counter, group_names: List[str],
+            parents: Tuple[str, ...] = ()
+    ) -> str:
+        return _GROUP_RE.sub(
+            lambda group_match: self._build_group(group_match, template, group_counter, group_names, parents), pattern
+        )
+
+    def _build_group(
+            self, group_match: regex.regex.Match, template: str, group_counter: Counter, group_names: List[str],
+            parents: Tuple[str, ...] = ()
+    ) -> str:
         group_key = group_match.group("key")
         special = group_match.group("special")
         alts = self.patterns_src.get(group_key)
+        if alts is not None and special != "#":
+            self._check_circular(group_key, parents)
+            parents += (group_key,)
         if alts is not None:
-            group_count = self.group_counter[group_key]
+            group_count = group_counter[group_key]
             if special is None:
-                new_pattern = pattern.replace(
-                    f"{{{{{group_key}}}}}",
-                    f"(?P<{group_key}_{group_count}>{self._pipe_together(alts)})",
-                    1
-                )
-                self.all_groups[template].append(f"{group_key}_{group_count}")
-                self.group_counter[group_key] += 1
-            else:
-                if special == "#":
-                    back_reference_index = int(group_match.group("index")) if group_match.group("index") else 1
-                    assert group_count >= back_reference_index, f"Attempting to reference non-existing group: " \
-                                                                f"{group_key}_{group_count - back_reference_index}"
-                    new_pattern = pattern.replace(
-                        f"{{{{{group_match.group(1)}}}}}",
-                        f"(?P={group_key}_{group_count - back_reference_index})",
-                        1
-                    )
-                else:
-                    new_pattern = pattern.replace(
-                        f"{{{{{special+group_key}}}}}",
-                        f"({special}{self._pipe_together(alts)})",
-                        1
-                    )
-                    self.group_counter[group_key] += 1
-        else:
-            if special:
-                raise Exception(f"`{special}{group_key}` does not exist. Template: {template!r}")
-            for sk in ["?:", "?>", "?!", "?=", "?<=", "?<!", "?a:", "?i:", "?m:", "?s:", "?x:", "?l:"]:
-                alts = self.patterns_src.get(f"{sk}{group_key}")
-                if alts is not None:
-                    new_pattern = pattern.replace(
-                        f"{{{{{group_key}}}}}",
-                        f"({sk}{self._pipe_together(alts)})"
-                    )
-                    assert new_pattern != pattern, f"Could not build pattern '{group_key}'"
-                    return new_pattern
+                group_name = sys.intern(f"{group_key}_{group_count}")
+                group_names.append(group_name)
+                group_counter[group_key] += 1
+                expanded = self._expand(self._pipe_together(alts), template, group_counter, group_names, parents)
+                return f"(?P<{group_name}>{expanded})"
+            if special == "#":
+                back_reference_index = int(group_match.group("index")) if group_match.group("index") else 1
+                assert group_count >= back_reference_index, f"Attempting to reference non-existing group: " \
+                                                            f"{group_key}_{group_count - back_reference_index}"
+                return f"(?P={group_key}_{group_count - back_reference_index})"
+            group_counter[group_key] += 1
+            expanded = self._expand(self._pipe_together(alts), template, group_counter, group_names, parents)
+            return f"({special}{expanded})"
+        if special:
+            raise Exception(f"`{special}{group_key}` does not exist. Template: {template!r}")
+        if (special_alts := self._special_alts.get(group_key)) is None:
             raise UnknownTemplateGroup(group_key)
-        return new_pattern
+        sk, alts = special_alts
+        self._check_circular(f"{sk}{group_key}", parents)
+        parents += (f"{sk}{group_key}",)
+        return f"({sk}{self._expand(self._pipe_together(alts), template, group_counter, group_names, parents)})"
+
+    @staticmethod
+    def _check_circular(group_key: str, parents: Tuple[str, ...]) -> None:
+        if group_key in parents:
+            chain = " -> ".join(parents[parents.index(group_key):] + (group_key,))
+            raise PatternBuildException(f"Circular reference in pattern templates: {chain}")
 
     @staticmethod
-    def _pipe_together(alts: List[str]) -> str:
+    @lru_cache(maxsize=None)
+    def _pipe_together(alts: Tuple[str, ...]) -> str:
         return "|".join(alts)
 
     @staticmethod
@@ -314,34 +587,38 @@ class Replus:
         :rtype: Union[List[Match], List[Group]]
         """
 
-        matches.sort(key=lambda x: x._start)
-        purged: Union[List["Match"], List["Group"]] = []  # type: ignore
+        matches.sort(key=attrgetter("_start"))
+        return Replus._purge_sorted(matches)
+
+    @staticmethod
+    def _purge_sorted(matches: Union[List["Match"], List["Group"]]) -> Union[List["Match"], List["Group"]]:
         if len(matches) <= 1:
             return matches
-        purged.append(matches[0])  # type: ignore
-        for m in matches[1:]:
-            if m._start >= purged[-1]._end:
-                purged.append(m)  # type: ignore
-            else:
-                if m._end >= purged[-1]._end:
-                    if m.length > purged[-1].length:
-                        purged.pop()
-                        purged.append(m)  # type: ignore
-        return purged
+        purged = [matches[0]]
+        last_start, last_end = matches[0]._start, matches[0]._end
+        for i in range(1, len(matches)):
+            m = matches[i]
+            start, end = m._start, m._end
+            if start >= last_end:
+                purged.append(m)
+                last_start, last_end = start, end
+            elif end >= last_end and end - start > last_end - last_start:
+                purged[-1] = m
+                last_start, last_end = start, end
+        return purged  # type: ignore
 
     @staticmethod
     def _load_models(
             patterns: Union[str, os.PathLike, Dict[str, Dict[str, List[str]]]]
-    ) -> Tuple[Dict[str, List[str]], Dict[str, List[str]]]:
-        def _iter_from_path(patterns_path: Union[str, os.PathLike]) -> Generator[Tuple[Path, str, Dict[str, List[str]]], None, None]:  # noqa E501
-            patterns_path = Path(patterns_path).absolute()
-            for pattern_filepath_ in patterns_path.iterdir():
-                if not (pattern_filepath_.is_file() and pattern_filepath_.suffix == ".json"):
-                    continue
-                patterns_name_ = pattern_filepath_.stem
-                with pattern_filepath_.open("r") as f:
-                    config_obj_ = json.load(f)
-                yield pattern_filepath_, patterns_name_, config_obj_
+    ) -> Tuple[Dict[str, Tuple[str, ...]], Dict[str, List[str]]]:
+        def _iter_from_path(patterns_path: Union[str, os.PathLike]) -> Generator[Tuple[str, str, Dict[str, List[str]]], None, None]:  # noqa E501
+            with os.scandir(os.fspath(patterns_path)) as entries:
+                for entry in entries:
+                    if not (entry.name.endswith(".json") and len(entry.name) > 5 and entry.is_file()):
+                        continue
+                    with open(entry.path, "rb") as f:
+                        config_obj_ = json_loads(f.read())
+                    yield entry.path, entry.name[:-5], config_obj_
 
         def _iter_from_dict(patterns_dict: Dict[str, Dict]) -> Generator[Tuple[str, str, Dict[str, List[str]]], None, None]:  # noqa E501]:
             for patterns_name_, config_obj_ in patterns_dict.items():
@@ -353,26 +630,175 @@ class Replus:
             patterns_iterator = _iter_from_dict(patterns)  # type: ignore
         else:
             raise TypeError(f"'patterns' must be of type str, os.PathLike or dict, got {type(patterns)} instead")
-        patterns_src: Dict[str, List[str]] = {}
+        patterns_src: Dict[str, Tuple[str, ...]] = {}
         patterns_all: Dict[str, List[str]] = {}
         loaded: Dict[str, str] = {}
         for pattern_filepath, patterns_name, config_obj in patterns_iterator:
             if run_patterns := config_obj.pop("$PATTERNS", None):
-                patterns_all[patterns_name] = run_patterns
-            for k in config_obj:
-                if k in loaded:
-                    raise KeyError(
-                        f"Duplicated pattern name \"{k}\" in {str(pattern_filepath)} "
-                        f"already loaded from {loaded[k]}"
-                    )
-                else:
-                    loaded[k] = str(pattern_filepath)
-            patterns_src.update(config_obj)
+                patterns_all[sys.intern(patterns_name)] = run_patterns
+            if loaded.keys() & config_obj.keys():
+                # report the first duplicate in file order
+                k = next(k for k in config_obj if k in loaded)
+                raise KeyError(
+                    f"Duplicated pattern name \"{k}\" in {str(pattern_filepath)} "
+                    f"already loaded from {loaded[k]}"
+                )
+            loaded |= dict.fromkeys(config_obj, str(pattern_filepath))
+            patterns_src |= {sys.intern(k): tuple(alts) for k, alts in config_obj.items()}
         return patterns_src, patterns_all
 
 
+_GROUP_RE = regex.compile(Replus.group_pattern)
+_AUTOMATON_MIN_LITERALS = 32  # distinct required literals an engine needs for the automaton to be built
+_AUTOMATON_MIN_TEMPLATES = 32  # templates a single call must select for the automaton to be used over str.find
+_CACHE_FORMAT = 1  # bump whenever the pickled layout or the derivation of cached data (e.g. _required_literal) changes
+_WS_NOISE_RE = regex.compile(r" +|\\\s+")
+_EXPANSIONS: Dict[Tuple[str, Optional[str], str], Tuple[str, Tuple[str, ...]]] = {}
+_EXPANSIONS_MAXSIZE = 4096
+_EXPANSIONS_LOCK = threading.Lock()
+_COMPILE_FAILURES: Dict[Tuple[str, Optional[int]], Exception] = {}
+_COMPILE_FAILURES_MAXSIZE = 256
+_COMPILE_FAILURES_LOCK = threading.Lock()
+_SCAN_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_SCAN_EXECUTOR_LOCK = threading.Lock()
+_INLINE_FLAGS_RE = regex.compile(r"\(\?[\^\w-]*\)")
+
+
+def _required_literal(pattern: regex.Pattern) -> str:
+    # the longest run of literal characters at the top level of the pattern, i.e. a substring that every match
+    # must contain; whenever the pattern is not simple enough to be sure, returns an empty string
+    source = pattern.pattern
+    if pattern.flags & (regex.IGNORECASE | regex.VERBOSE) or _INLINE_FLAGS_RE.search(source):
+        return ""
+    longest = ""
+    run: List[str] = []
+    depth = 0
+    i = 0
+    while i < len(source):
+        char = source[i]
+        literal = None
+        step = 1
+        if char == "\\":
+            escaped = source[i + 1:i + 2]
+            if not escaped.isalnum():
+                literal = escaped
+            elif escaped not in "bBdDsSwWAZGKmM":  # escapes with arguments or of unknown length: give up
+                return ""
+            step = 2
+        elif char == "[":
+            class_end = _class_end(source, i)
+            if class_end < 0:
+                return ""
+            step = class_end - i
+        elif source.startswith("(?#", i):
+            comment_end = source.find(")", i)
+            if comment_end < 0:
+                return ""
+            step = comment_end + 1 - i
+        elif char == "{":  # a counted repeat or a fuzzy constraint, whose content is not literal text
+            brace_end = source.find("}", i)
+            if brace_end < 0:
+                return ""
+            step = brace_end + 1 - i
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return ""
+        elif char not in ".^$*+?{}|":
+            literal = char
+        if depth == 0 and literal is not None:
+            run.append(literal)
+        elif run:
+            if char in "*+?{":  # the quantifier applies to the last literal character only
+                run.pop()
+            if len(run) > len(longest):
+                longest = "".join(run)
+            run = []
+        i += step
+    if len(run) > len(longest):
+        longest = "".join(run)
+    return longest
+
+
+def _class_end(source: str, i: int) -> int:
+    # the index right after the character class opened at source[i], or -1 if it contains nested sets
+    j = i + 1
+    if source[j:j + 1] == "^":
+        j += 1
+    if source[j:j + 1] == "]":
+        j += 1
+    while j < len(source):
+        char = source[j]
+        if char == "\\":
+            j += 2
+            continue
+        if char == "[":
+            if source[j + 1:j + 2] != ":" or (posix_end := source.find(":]", j + 2)) < 0:
+                return -1
+            j = posix_end + 2
+            continue
+        if char == "]":
+            return j + 1
+        j += 1
+    return -1
+
+
+def _scan_executor() -> ThreadPoolExecutor:
+    # a single pool, sized to the number of CPUs, is shared by the parallel parses of all the engines
+    global _SCAN_EXECUTOR
+    if _SCAN_EXECUTOR is None:
+        with _SCAN_EXECUTOR_LOCK:
+            if _SCAN_EXECUTOR is None:
+                _SCAN_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="replus")
+    return _SCAN_EXECUTOR
+
+
+def _version_flags(flags: Optional[int]) -> int:
+    # the regex module's version 1 behaviour is added unless version 0 is explicitly requested
+    flags = flags or 0
+    return flags if flags & regex.V0 else flags | regex.V1
+
+
+@lru_cache(maxsize=32)
+def _cached_engine(
+        cls: type, patterns_dir: str, whitespace_noise: Optional[str], flags: int, max_workers: Optional[int],
+        cache_dir: Optional[str]
+) -> Replus:
+    # called by Replus.cached with normalised arguments, so that equivalent configurations share one engine
+    return cls(patterns_dir, whitespace_noise=whitespace_noise, flags=flags, max_workers=max_workers, cache_dir=cache_dir)
+
+
+@lru_cache(maxsize=4096)
+def _group_key(group_name: str) -> str:
+    # group names are built as f"{key}_{count}"; any other name is its own key
+    key, _, rep = group_name.rpartition("_")
+    return key if rep.isdecimal() else group_name
+
+
+def _compile_pattern(job: Tuple[str, Optional[int]]) -> Union[regex.Pattern, Exception]:
+    # module-level so that it can be pickled into worker processes; compiled patterns are sent back pickled,
+    # and unpickling a regex.Pattern restores its compiled code without parsing the pattern again.
+    # Successful compilations are cached by the regex module, failures are remembered here so that a broken pattern
+    # is only compiled once per process
+    if (failure := _COMPILE_FAILURES.get(job)) is not None:
+        return failure
+    pattern, flags = job
+    try:
+        return regex.compile(pattern, flags=flags)
+    except Exception as e:
+        with _COMPILE_FAILURES_LOCK:
+            if len(_COMPILE_FAILURES) >= _COMPILE_FAILURES_MAXSIZE:
+                del _COMPILE_FAILURES[next(iter(_COMPILE_FAILURES))]
+            _COMPILE_FAILURES[job] = e.with_traceback(None)
+        return e
+
+
 class AbstractMatch(abc.ABC):
 
+    __slots__ = ()
+
     def serialize(self) -> dict:
         """
         Returns a dict representation of the Match object structured as follows
@@ -391,20 +817,47 @@ class AbstractMatch(abc.ABC):
         :rtype: dict
         """
 
+        o: Dict[str, Any]
         if type(self) is Group:
             o = {"key": self.key, "name": self.name}  # type: ignore
         else:
             o = {"type": self.type}  # type: ignore
+        groups: Dict[str, List[dict]] = {}
         o.update({
-            "offset": self.offset,  # type: ignore
+            "offset": {"start": self._start, "end": self._end},  # type: ignore
             "value": self.value,  # type: ignore
-            "groups": defaultdict(list)
+            "groups": groups
         })
         for g in self.groups(root=True):
-            o["groups"][g.key].append(g.serialize())
-        o["groups"] = dict(o["groups"])
+            groups.setdefault(g.key, []).append(g.serialize())
         return o
 
+    @property
+    def offset(self) -> Dict[str, int]:
+        """
+        The offset of the match ``{"start": int, "end": int}``, built on access
+
+        :return: the offset of the match
+        :rtype: Dict[str, int]
+        """
+
+        return {"start": self._start, "end": self._end}  # type: ignore
+
+    @property
+    def length(self) -> int:
+        """
+        The length of the match (no. of characters)
+
+        :return: the length of the match
+        :rtype: int
+        """
+
+        return self._end - self._start  # type: ignore
+
+    @property
+    def _span(self) -> Tuple[int, int]:
+        return self._start, self._end  # type: ignore
+
     @abc.abstractmethod
     def groups(self, group_query: Optional[str] = None, root: bool = False) -> List["Group"]:
         """"""
@@ -543,21 +996,34 @@ class Match(AbstractMatch):
     :ivar match: a regex.regex.Match object
     :ivar partial: if it's a partial match
     :ivar value: the string value of the match
-    :ivar offset: the offset of the match ``{"start": int, "end": int}``
     :ivar pattern: the string representation of the pattern that matched
     :ivar length: the length of the match (no. of characters)
     :ivar all_group_names: all the names of all the groups for the corresponding pattern for this match
+    :ivar group_index: the position of each group name in all_group_names
+    :ivar _pattern: the regex.regex.Pattern that matched
     :ivar _start: the start offset of the Match
     :ivar _end: the end offset Match
     :ivar _span: the span of the Match (_start, _end)
+    :ivar _group_ids: the number of each group of all_group_names in the pattern
+    :ivar _spans: a flat table of ``(group_id, rep_index, start, end)`` rows sorted by start, computed on first access
+    :ivar _groups_cache: the Group objects of the Match sorted by start, computed on first access
+    :ivar _parents: the parent of each ``(group_name, rep_index)`` of the Match, computed on first access
+    :ivar _serialized: the dict representation of the Match used by json(), computed on first access
     """
 
+    __slots__ = (
+        "type", "match", "partial", "value", "all_group_names", "group_index",
+        "_pattern", "_group_ids", "_start", "_end", "_spans", "_groups_cache", "_parents", "_serialized"
+    )
+
     def __init__(
             self,
             match_type: str,
             match: regex.regex.Match,
-            all_groups_names: List[str],
-            pattern: regex.regex.Pattern
+            all_groups_names: Sequence[str],
+            pattern: regex.regex.Pattern,
+            group_index: Optional[Dict[str, int]] = None,
+            group_ids: Optional[Sequence[int]] = None
     ):
         """
         Instantiates a Match object
@@ -569,23 +1035,59 @@ class Match(AbstractMatch):
         :type match: regex.regex.Match
 
         :param all_groups_names: all the names of all the groups for the corresponding pattern for this match
-        :type all_groups_names: List[str]
+        :type all_groups_names: Sequence[str]
 
         :param pattern: the pattern that matched
         :type: pattern: regex.regex.Pattern
+
+        :param group_index: the position of each group name in all_groups_names; built if not provided
+        :type group_index: Dict[str, int], defaults to None
+
+        :param group_ids: the number of each group of all_groups_names in the pattern; built if not provided
+        :type group_ids: Sequence[int], defaults to None
         """
 
         self.type = match_type
         self.match = match
         self.partial = match.partial
         self.value = match.group()
-        self.offset = {"start": self.start(), "end": self.end()}
-        self.pattern = pattern.pattern
-        self.length = self.end() - self.start()
+        self._pattern = pattern
         self.all_group_names = all_groups_names
-        self._start = self.start()
-        self._end = self.end()
-        self._span = self.span()
+        if group_index is None:
+            group_index = {name: i for i, name in enumerate(all_groups_names)}
+        self.group_index = group_index
+        if group_ids is None:
+            group_ids = [pattern.groupindex[name] for name in all_groups_names]
+        self._group_ids = group_ids
+        self._start, self._end = match.span()
+        self._spans: Optional[List[Tuple[int, int, int, int]]] = None
+        self._groups_cache: Optional[List[Group]] = None
+        self._parents: Optional[Dict[Tuple[str, int], Union[Match, Group]]] = None
+        self._serialized: Optional[dict] = None
+
+    def json(self, *args: Any, **kwargs: Any) -> str:
+        """
+        Returns a json-string of the serialized object; the serialized dict is computed once and kept internally, so
+        that repeated calls only pay for the dump
+
+        :return: a json-string of the serialized object
+        :rtype: str
+        """
+
+        if self._serialized is None:
+            self._serialized = self.serialize()
+        return json.dumps(self._serialized, *args, **kwargs)
+
+    @property
+    def pattern(self) -> str:
+        """
+        The string representation of the pattern that matched
+
+        :return: the pattern that matched
+        :rtype: str
+        """
+
+        return self._pattern.pattern
 
     def groups(self, group_query: Optional[str] = None, root: bool = False) -> List["Group"]:
         """
@@ -601,30 +1103,90 @@ class Match(AbstractMatch):
         :rtype: List[Group]
         """
 
-        groups = []
-        all_groups = [group_query] if group_query is not None else self.all_group_names
-        for group_name in all_groups:
-            i = 0
-            group_i = group_name
-            while True:
-                if group_query is not None:
-                    group_i = f"{group_name}_{i}"
-                try:
-                    g = self.match.group(group_i)
-                    if g is not None:
-                        for j, (start, end) in enumerate(self.match.spans(group_i)):
-                            if self._start <= start and end <= self._end:
-                                groups.append(Group(self.match, group_i, self, rep_index=j))
-                except IndexError:
-                    break
-                if group_query is None:
-                    break
-                i += 1
-        groups.sort(key=lambda x: x._start)
+        if group_query is None:
+            groups = list(self._cached_groups())
+        else:
+            groups = [group for group in self._cached_groups() if group.key == group_query]
         if root:
-            return Replus.purge_overlaps(groups)  # type: ignore
+            return Replus._purge_sorted(groups)  # type: ignore
         return groups
-    
+
+    def group(self, group_name: str) -> Optional["Group"]:
+        """
+        Returns a Group object with the given group_name or None
+
+        :param group_name: the name of the group
+        :type group_name: str
+
+        :return: a Group object
+        :rtype: Optional[Group]
+        """
+
+        for group in self._cached_groups():
+            if group.key == group_name:
+                return group
+        return None
+
+    def first(self) -> Optional["Group"]:
+        """
+        Returns the first Group object or None
+
+        :return: the first Group object
+        :rtype: Union[Group, None]
+        """
+
+        groups = self._cached_groups()
+        return groups[0] if groups else None
+
+    def last(self) -> Optional["Group"]:
+        """
+        Returns the last Group object or None
+
+        :return: the last Group object
+        :rtype: Union[Group, None]
+        """
+
+        groups = self._cached_groups()
+        return groups[-1] if groups else None
+
+    def _cached_groups(self) -> List["Group"]:
+        if self._groups_cache is None:
+            self._groups_cache = self._compute_groups()
+        return self._groups_cache
+
+    def _compute_groups(self) -> List["Group"]:
+        names = self.all_group_names
+        string = self.match.string
+        return [
+            Group(self.match, names[group_id], self, rep_index=rep_index, start=start, end=end, value=string[start:end])
+            for group_id, rep_index, start, end in self._span_table()
+        ]
+
+    def _parent_of(self, group: "Group") -> Union["Match", "Group"]:
+        if self._parents is None:
+            # a single pass over the groups sorted by start, where outer groups precede the groups they contain
+            parents: Dict[Tuple[str, int], Union[Match, Group]] = {}
+            stack: List[Group] = []
+            for g in self._cached_groups():
+                while stack and not (stack[-1]._start <= g._start and g._end <= stack[-1]._end):
+                    stack.pop()
+                parents[(g.name, g.rep_index)] = stack[-1] if stack else self
+                stack.append(g)
+            self._parents = parents
+        return self._parents.get((group.name, group.rep_index), self)
+
+    def _span_table(self) -> List[Tuple[int, int, int, int]]:
+        if self._spans is None:
+            spans = []
+            match_spans = self.match.spans
+            for group_id, regex_group_id in enumerate(self._group_ids):
+                for rep_index, (start, end) in enumerate(match_spans(regex_group_id)):
+                    if self._start <= start and end <= self._end:
+                        spans.append((group_id, rep_index, start, end))
+            spans.sort(key=itemgetter(2))
+            self._spans = spans
+        return self._spans
+
     def __repr__(self) -> str:
         return f"<[Match {self.type}] span{self._span}: {self.value}>"
 
@@ -639,7 +1201,6 @@ class Group(AbstractMatch):
     :ivar name: the name of the group, including its rep_index. E.g.: date_0
     :ivar key: the key of the group, i.e. the name without the rep_index
     :ivar value: the string value of the match
-    :ivar offset: the offset of the match ``{"start": int, "end": int}``
     :ivar length: the length of the match (no. of characters)
     :ivar rep_index: the repetition index
     :ivar _start: the start offset of the Match
@@ -647,18 +1208,52 @@ class Group(AbstractMatch):
     :ivar _span: the span of the Match (_start, _end)
     """
 
-    def __init__(self, match: regex.regex.Match, group_name: str, root: Match, rep_index: int = 0):
+    __slots__ = ("root", "match", "name", "key", "value", "rep_index", "_start", "_end")
+
+    def __init__(
+            self, match: regex.regex.Match, group_name: str, root: Match, rep_index: int = 0, *,
+            key: Optional[str] = None, start: Optional[int] = None, end: Optional[int] = None, value: Optional[str] = None
+    ):
+        """
+        Instantiates a Group object
+
+        :param match: a regex.regex.Match object
+        :type match: regex.regex.Match
+
+        :param group_name: the name of the group, including its rep_index. E.g.: date_0
+        :type group_name: str
+
+        :param root: the root Match object
+        :type root: Match
+
+        :param rep_index: the repetition index
+        :type rep_index: int, defaults to 0
+
+        :param key: the key of the group, if already known; derived from group_name if not provided
+        :type key: str, defaults to None
+
+        :param start: the start offset of the group, if already known; must be given together with end
+        :type start: int, defaults to None
+
+        :param end: the end offset of the group, if already known; must be given together with start
+        :type end: int, defaults to None
+
+        :param value: the string value of the group, if already known
+        :type value: str, defaults to None
+        """
+
         self.root = root
         self.match = match
         self.name = group_name
-        self.key = regex.sub(r"_\d+$", r"", self.name)
-        self.value = match.captures(group_name)[rep_index]
+        self.key = key if key is not None else _group_key(group_name)
+        if value is None:
+            value = match.captures(group_name)[rep_index]
+        self.value = value
         self.rep_index = rep_index
-        self.offset = {"start": self.start(), "end": self.end()}
-        self.length = self.end() - self.start()
-        self._start = self.start()
-        self._end = self.end()
-        self._span = self.span()
+        if start is None or end is None:
+            start, end = match.spans(group_name)[rep_index]
+        self._start = start
+        self._end = end
 
     def groups(self, group_query: Optional[str] = None, root: bool = False) -> List["Group"]:
         """
@@ -674,34 +1269,30 @@ class Group(AbstractMatch):
         :rtype: List[Group]
         """
 
-        def is_next(g1: str, g2: str) -> bool:
-            return self.root.all_group_names.index(g1) > self.root.all_group_names.index(g2)
-
+        # the children are read from the root's table of captured groups, which is already sorted by start
+        self_index = self.root.group_index[self.name]
         groups = []
-        all_groups = [group_query] if group_query is not None else self.root.all_group_names
-        for group_name in all_groups:
-            i = 0
-            group_i = group_name
-            while True:
-                if group_query is not None:
-                    group_i = f"{group_name}_{i}"
-                if self.name != group_i:  # doesn't return itself, just its children
-                    try:
-                        g = self.match.group(group_i)
-                        if g is not None and is_next(group_i, self.name):  # returning just its children
-                            for j, (start, end) in enumerate(self.match.spans(group_i)):
-                                if self._start <= start and end <= self._end:
-                                    groups.append(self.__class__(self.match, group_i, self.root, rep_index=j))
-                    except IndexError:
-                        break
-                if group_query is None:
-                    break
-                i += 1
-        groups.sort(key=lambda x: x._start)
+        for (group_id, _, start, end), group in zip(self.root._span_table(), self.root._cached_groups()):
+            if start > self._end:
+                break
+            if group_id > self_index and self._start <= start and end <= self._end:
+                if group_query is None or group.key == group_query:
+                    groups.append(group)
         if root:
-            return Replus.purge_overlaps(groups)  # type: ignore
+            return Replus._purge_sorted(groups)  # type: ignore
         return groups
 
+    @property
+    def parent(self) -> Union[Match, "Group"]:
+        """
+        The innermost Group object that contains the Group object, or the root Match object
+
+        :return: the parent Group or Match object
+        :rtype: Union[Match, Group]
+        """
+
+        return self.root._parent_of(self)
+
     def reps(self) -> List["Group"]:
         """
         Returns a list of the Group object's repetitions
@@ -710,10 +1301,15 @@ class Group(AbstractMatch):
         :rtype: List[Group]
         """
 
-        if len(self.match.starts(self.name)) > 1:
+        spans = self.match.spans(self.name)
+        if len(spans) > 1:
+            string = self.match.string
             return [
-                self.__class__(self.match, self.name, self.root, rep_index=i)
-                for i in range(len(self.match.starts(self.name)))
+                self.__class__(
+                    self.match, self.name, self.root, rep_index=i, key=self.key,
+                    start=start, end=end, value=string[start:end]
+                )
+                for i, (start, end) in enumerate(spans)
             ]
         return []
 
@@ -0,0 +1,26 @@
+from pathlib import Path
+
+import pytest
+import regex
+
+from replus import Replus
+from .test_models.date import date
+from .test_models.repeated import repeated
+from .test_models.tests import tests
+
+HERE = Path(__file__).parent.absolute()
+
+
+@pytest.fixture(scope="session")
+def engine() -> Replus:
+    return Replus(dict(date=date, repeated=repeated, tests=tests))
+
+
+@pytest.fixture(scope="session")
+def engine_from_path() -> Replus:
+    return Replus(HERE / "test_models")
+
+
+@pytest.fixture(scope="session")
+def engine_i() -> Replus:
+    return Replus(HERE / "test_models", flags=regex.IGNORECASE)
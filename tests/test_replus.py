@@ -1,21 +1,20 @@
+import pickle
 from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
 
 import pytest
 import regex
 
+import replus
 from replus import Replus
 from replus import exceptions
-from .test_models.date import date
-from .test_models.repeated import repeated
-from .test_models.tests import tests
 
 HERE = Path(__file__).parent.absolute()
 
-engine = Replus(dict(date=date, repeated=repeated, tests=tests))
 
-
-def test_parser_regex() -> None:
-    patterns = [p.pattern for k, p, t in engine.patterns if k == "tests"]
+def test_parser_regex(engine: Replus) -> None:
+    patterns = [p.pattern for p in engine.patterns_by_key["tests"]]
     expected = [
         r"This is an unnamed number group: (?:\d).",
         r"I can match (?P<abg_0>alpha|beta|gamma) and "
@@ -25,21 +24,25 @@ def test_parser_regex() -> None:
         r"(?<!foo|bar) blah blah, (?!foo|bar) foo foo, (?<=foo|bar) bar bar, (?=foo|bar) yoyo",
         r"(?<=alpha|beta|gamma) (?<!alpha|beta|gamma) (?!alpha|beta|gamma) (?=alpha|beta|gamma)"
     ]
-    for i, p in enumerate(patterns):
-        assert p == expected[i]
+    assert patterns == expected
 
 
-def test_flags() -> None:
-    test_models_path = HERE / "test_models"
-    engine_i = Replus(test_models_path, flags=regex.IGNORECASE)
-    matches = engine_i.parse("Today it's January 1st 1970")
-    assert len(matches) == 1
-    engine_ii = Replus(test_models_path)
-    matches = engine_ii.parse("Today it's January 1st 1970")
-    assert len(matches) == 0
+@pytest.mark.parametrize("engine_name, expected_len", [("engine_i", 1), ("engine_from_path", 0)])
+def test_flags(request: pytest.FixtureRequest, engine_name: str, expected_len: int) -> None:
+    matches = request.getfixturevalue(engine_name).parse("Today it's January 1st 1970")
+    assert len(matches) == expected_len
+
+
+def test_version1_default() -> None:
+    def _patterns() -> dict:  # a new dict for each engine, as loading the models pops "$PATTERNS"
+        return {"test": {"consonants": ["[[a-z]--[aeiou]]+"], "$PATTERNS": ["{{consonants}}"]}}
 
+    assert [m.value for m in Replus(_patterns()).parse("strength")] == ["str", "ngth"]
+    assert [m.value for m in Replus(_patterns(), flags=regex.IGNORECASE).parse("STRENGTH")] == ["STR", "NGTH"]
+    assert Replus(_patterns(), flags=regex.V0).parse("strength") == []
 
-def test_match() -> None:
+
+def test_match(engine: Replus) -> None:
     matches = engine.parse("Today is january 1st 1970")
     assert len(matches) == 1
     date_ = matches[0]
@@ -52,33 +55,32 @@ def test_match() -> None:
     assert year.value == "1970"
 
 
-def test_search_returns_none() -> None:
+def test_search_returns_none(engine: Replus) -> None:
     date_match = engine.search("Today is january 1st 19xx")
     assert date_match is None
 
 
-def test_match_with_no_groups() -> None:
-    _engine = Replus(HERE / "test_models")
-    match = _engine.search("Pattern with no groups")
+def test_match_with_no_groups(engine_from_path: Replus) -> None:
+    match = engine_from_path.search("Pattern with no groups")
     assert match.first() is None
     assert match.last() is None
 
 
-def test_first() -> None:
+def test_first(engine: Replus) -> None:
     date_match = engine.search("Today is january 1st 1970", filters=["date"])
     first = date_match.first()
     assert first is not None
     assert first.value == "january 1st 1970"
 
 
-def test_last() -> None:
+def test_last(engine: Replus) -> None:
     date_match = engine.search("Today is january 1st 1970", filters=["date"])
     last = date_match.last()
     assert last is not None
     assert last.value == "1970"
 
 
-def test_start_end() -> None:
+def test_start_end(engine: Replus) -> None:
     date_match = engine.search("Today is january 1st 1970", filters=["date"])
     assert date_match.start() == 9
     assert date_match.start("year") == 21
@@ -86,7 +88,7 @@ def test_start_end() -> None:
     assert date_match.end("year") == 25
 
 
-def test_start_end_no_such_group() -> None:
+def test_start_end_no_such_group(engine: Replus) -> None:
     date_match = engine.search("Today is january 1st 1970", filters=["date"])
     with pytest.raises(exceptions.NoSuchGroup):
         _ = date_match.start("foo")
@@ -94,24 +96,45 @@ def test_start_end_no_such_group() -> None:
         _ = date_match.end("foo")
 
 
-def test_span() -> None:
+def test_span(engine: Replus) -> None:
     date_match = engine.search("Today is january 1st 1970", filters=["date"])
     assert date_match.span() == (9, 25)
     assert date_match.span("year") == (21, 25)
 
 
-def test_span_no_such_group() -> None:
+def test_span_no_such_group(engine: Replus) -> None:
     date_match = engine.search("Today is january 1st 1970", filters=["date"])
     with pytest.raises(exceptions.NoSuchGroup):
         _ = date_match.span("foo")
 
 
-def test_repeat() -> None:
+def test_repeat(engine: Replus) -> None:
     repeat_match = engine.search("foobar 34 of 1997 15 of 1988 45 of 1975")
     assert len(repeat_match.group("numyear").reps()) == 3
 
 
-def test_partial() -> None:
+def test_parent(engine: Replus) -> None:
+    repeat_match = engine.search("foobar 34 of 1997 15 of 1988 45 of 1975")
+    numyear = repeat_match.group("numyear")
+    assert numyear.parent is repeat_match
+    for rep in numyear.reps():
+        assert all(child.parent.span() == rep.span() for child in rep.groups())
+
+
+def test_slots(engine: Replus) -> None:
+    repeat_match = engine.search("foobar 34 of 1997 15 of 1988 45 of 1975")
+    for obj in (repeat_match, repeat_match.group("numyear")):
+        assert not hasattr(obj, "__dict__")
+        with pytest.raises(AttributeError):
+            obj.foo = "bar"  # type: ignore
+
+
+def test_parallel(engine: Replus) -> None:
+    string = "foobar 34 of 1997 15 of 1988 and then 12/10/2012 or january 1st 1970"
+    assert [repr(m) for m in engine.parse(string, parallel=True)] == [repr(m) for m in engine.parse(string)]
+
+
+def test_partial(engine: Replus) -> None:
     partial_match = engine.search("march 3rd", partial=True)
     assert partial_match is not None, "Did not match"
     assert partial_match.partial
@@ -130,6 +153,36 @@ def test_build_pattern_error() -> None:
         _ = Replus(_patterns)
 
 
+def test_build_pattern_error_cached(monkeypatch: pytest.MonkeyPatch) -> None:
+    def _patterns() -> dict:
+        return {"test": {"broken": ["a (broken pattern"], "$PATTERNS": ["{{broken}}"]}}
+
+    compiled = []
+    compile_ = regex.compile
+
+    def _compile(pattern: str, *args: Any, **kwargs: Any) -> regex.Pattern:
+        compiled.append(pattern)
+        return compile_(pattern, *args, **kwargs)
+
+    monkeypatch.setattr(regex, "compile", _compile)
+    for _ in range(2):
+        with pytest.raises(exceptions.PatternBuildException):
+            _ = Replus(_patterns())
+    assert compiled == ["(?P<broken_0>a (broken pattern)"]
+
+
+def test_pattern_circular_reference() -> None:
+    _patterns = {
+        "test": {
+            "a": ["x{{b}}"],
+            "?:b": ["y|{{a}}"],
+            "$PATTERNS": ["{{a}}"],
+        }
+    }
+    with pytest.raises(exceptions.PatternBuildException, match="a -> \\?:b -> a"):
+        _ = Replus(_patterns)
+
+
 def test_whitespace_noise() -> None:
     _patterns = {
         "test": {
@@ -145,11 +198,58 @@ def test_whitespace_noise() -> None:
     assert matches[0].value == "This#is#a#test#pattern"
 
 
-def test_json() -> None:
+def test_counted_repeats() -> None:
+    _patterns = {
+        "test": {
+            "era": ["AD|BC"],
+            "$PATTERNS": ["\\d{4} {{era}}", "x{2,3}y", "(?:colour){e<=1} red"],
+        }
+    }
+    _engine = Replus(_patterns)
+    string = "in 1970 AD and xxy, a color red"
+    assert [m.value for m in _engine.parse(string)] == ["1970 AD", "xxy", "color red"]
+    assert _engine.search(string).value == "1970 AD"
+
+
+def test_reverse() -> None:
+    _engine = Replus({"test": {"w": ["foo|foobar"], "$PATTERNS": ["{{w}}", "(?r)\\d+"]}})
+    string = "1 foobar 22 foo 333"
+    assert [m.value for m in _engine.parse(string)] == ["1", "foo", "22", "foo", "333"]
+    assert [m.value for m in _engine.parse(string, parallel=True)] == ["1", "foo", "22", "foo", "333"]
+    assert _engine.search(string).value == "1"
+    overlapped = [(m.value, m.start()) for m in _engine.parse(string, overlapped=True)]
+    assert overlapped == [("1", 0), ("foo", 2), ("22", 9), ("2", 9), ("foo", 12), ("333", 16), ("33", 16), ("3", 16)]
+
+
+def test_literals_automaton(monkeypatch: pytest.MonkeyPatch) -> None:
+    pytest.importorskip("ahocorasick")
+
+    def _patterns() -> dict:
+        return {"test": {"$PATTERNS": [f"item{i}: \\d{{2,4}}" for i in range(40)] + ["\\d{4} AD", "x{2,3}y"]}}
+
+    _engine = Replus(_patterns())
+    assert _engine._literals_automaton is not None
+    monkeypatch.setattr(replus, "ahocorasick", None)
+    _engine_find = Replus(_patterns())
+    assert _engine_find._literals_automaton is None
+    string = " ".join(f"item{i}: {i * 37}" for i in range(0, 40, 3)) + " in 1970 AD and xxy"
+    assert [m.value for m in _engine.parse(string)][-3:] == ["item39: 1443", "1970 AD", "xxy"]
+    for kwargs in ({}, {"overlapped": True}, {"pos": 20, "endpos": 90}, {"filters": ["test"]}):
+        matches = _engine.parse(string, **kwargs)
+        assert matches
+        assert [repr(m) for m in matches] == [repr(m) for m in _engine_find.parse(string, **kwargs)]
+
+
+def test_json(engine: Replus) -> None:
     matches = engine.parse("Here is some spam and some eggs")
     assert matches[0].json() == '{"type": "tests", "offset": {"start": 0, "end": 31}, "value": "Here is some spam and some eggs", "groups": {}}'  # noqa: E501
     matches = engine.parse("Today is january 1st 1970")
     assert matches[0].json() == '{"type": "date", "offset": {"start": 9, "end": 25}, "value": "january 1st 1970", "groups": {"date": [{"key": "date", "name": "date_0", "offset": {"start": 9, "end": 25}, "value": "january 1st 1970", "groups": {"month_name": [{"key": "month_name", "name": "month_name_0", "offset": {"start": 9, "end": 16}, "value": "january", "groups": {}}], "day": [{"key": "day", "name": "day_1", "offset": {"start": 17, "end": 18}, "value": "1", "groups": {}}], "year": [{"key": "year", "name": "year_1", "offset": {"start": 21, "end": 25}, "value": "1970", "groups": {}}]}}]}}'  # noqa: E501
+    dumped = matches[0].json()
+    serialized = matches[0].serialize()
+    assert serialized is not matches[0].serialize()
+    serialized["groups"]["date"][0]["value"] = "modified"
+    assert matches[0].json() == dumped
 
 
 def test_patterns_duplicate() -> None:
@@ -170,6 +270,51 @@ def test_patterns_invalid_group() -> None:
         _ = Replus(invalid_models)
 
 
+def test_max_workers(engine_from_path: Replus) -> None:
+    _engine = Replus(HERE / "test_models", max_workers=2)
+    expected = [p.pattern for _, p, _ in engine_from_path.patterns]
+    assert [p.pattern for _, p, _ in _engine.patterns] == expected
+    assert _engine.search("Today is january 1st 1970", filters=["date"]).value == "january 1st 1970"
+
+
+def test_cache_dir(tmp_path: Path) -> None:
+    _engine = Replus(HERE / "test_models", cache_dir=tmp_path)
+    assert len(list(tmp_path.glob("*.pkl"))) == 1
+    cached = Replus(HERE / "test_models", cache_dir=tmp_path)
+    assert [p.pattern for _, p, _ in cached.patterns] == [p.pattern for _, p, _ in _engine.patterns]
+    assert cached.search("Today is january 1st 1970", filters=["date"]).value == "january 1st 1970"
+    Replus(HERE / "test_models", cache_dir=tmp_path, flags=regex.IGNORECASE)
+    assert len(list(tmp_path.glob("*.pkl"))) == 2
+    for cache_path in tmp_path.glob("*.pkl"):
+        cache_path.write_bytes(pickle.dumps(("a", "b", "c", "d")))
+    rebuilt = Replus(HERE / "test_models", cache_dir=tmp_path)
+    assert [p.pattern for _, p, _ in rebuilt.patterns] == [p.pattern for _, p, _ in _engine.patterns]
+    not_a_dir = tmp_path / "file"
+    not_a_dir.write_text("")
+    assert Replus(HERE / "test_models", cache_dir=not_a_dir).search("january 1st 1970").value == "january 1st 1970"
+
+
+def test_cached(monkeypatch: pytest.MonkeyPatch) -> None:
+    _engine = Replus.cached(HERE / "test_models")
+    assert Replus.cached(HERE / "test_models") is _engine
+    assert Replus.cached(str(HERE / "test_models"), None, regex.V1) is _engine
+    monkeypatch.chdir(HERE)
+    assert Replus.cached("test_models") is _engine
+    monkeypatch.chdir(HERE.parent)
+    assert Replus.cached("tests/test_models") is _engine
+    assert Replus.cached(HERE / "test_models", flags=regex.IGNORECASE) is not _engine
+    assert _engine.search("Today is january 1st 1970", filters=["date"]).value == "january 1st 1970"
+
+
+def test_purge_overlaps() -> None:
+    def _m(start: int, end: int) -> SimpleNamespace:
+        return SimpleNamespace(_start=start, _end=end, length=end - start)
+
+    a, b, c, d, e = _m(0, 5), _m(3, 10), _m(4, 6), _m(10, 12), _m(10, 12)
+    purged = Replus.purge_overlaps([d, c, b, a, e])  # type: ignore
+    assert purged == [b, d]
+
+
 def test_init_wrong_type() -> None:
     with pytest.raises(TypeError):
         _ = Replus(1)  # type: ignore